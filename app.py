@@ -1,27 +1,50 @@
 # app.py
 import os
+import time
+import hashlib
+import shutil
+import html
+import sqlite3
+import threading
+import uuid
+import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import streamlit as st
 import google.generativeai as genai
+from google.generativeai import caching
 
 # ----- Streamlit UI -----
 st.set_page_config(page_title="🌙 Umeeda — Assistant", layout="centered")
 st.title("🌙 Umeeda — Your Secret Friend")
 st.caption("Umeeda answers using your uploaded knowledge base. Admin: use sidebar to upload or reindex.")
 # Import KB helpers (make sure kb_loader.py defines these)
-from kb_loader import load_index, retrieve, ingest_csv, build_index
+from kb_loader import (load_index, load_shadow_index, exact_scores, retrieve, search_breadth,
+                       ingest_csv, build_index, embed_queries, SHADOW_K_FACTOR)
+import faiss
+import numpy as np
+from batcher import PromptBatcher
 
 # ----- Config / guardrail prompt -----
-load_dotenv()
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-if not GOOGLE_API_KEY:
+# Use the working model you discovered earlier
+MODEL_NAME = "models/gemini-2.5-flash"
+
+@st.cache_resource
+def get_model():
+    """Configure the SDK and build the model once per server process (not on every rerun)."""
+    load_dotenv()
+    key = os.getenv("GOOGLE_API_KEY")
+    if not key:
+        return None
+    genai.configure(api_key=key)
+    return genai.GenerativeModel(MODEL_NAME)
+
+if get_model() is None:
+    get_model.clear()  # don't keep the missing-key result once .env is fixed
     st.error("GOOGLE_API_KEY not found in .env. Add it and restart.")
     st.stop()
 
-genai.configure(api_key=GOOGLE_API_KEY)
-# Use the working model you discovered earlier
-model = genai.GenerativeModel("models/gemini-2.5-flash")
-
 CULTURE_SYSTEM_PROMPT = """
 You are Umeeda, an assistant for users in Pakistan. Answer respectfully and according to Islamic and local cultural norms.
 Follow these rules:
@@ -32,103 +55,362 @@ Follow these rules:
 5. Be concise and, when appropriate, reference Islamic values respectfully.
 """
 
+# Prompts from concurrent sessions are packed into shared model calls
+@st.cache_resource
+def _get_batcher():
+    return PromptBatcher(max_batch=4, max_delay=0.05)
+
 # ----- Load index (if available) -----
-INDEX = None
-METADATA = None
-try:
-    INDEX, METADATA = load_index("data/kb_index.faiss", "data/metadata.pkl")
+@st.cache_resource
+def load_kb():
+    """
+    Load the FAISS index + metadata once and share the handle across all sessions and reruns.
+    Returns (index, metadata, shadow), where shadow is the exact index kept next to a PQ
+    index (None otherwise), or (None, None, None) if no index has been built yet.
+    Call load_kb.clear() after a rebuild.
+    """
+    try:
+        index, metadata = load_index("data/kb_index.faiss", "data/metadata.pkl")
+    except Exception:
+        # Quiet: index might not exist yet; admin UI can build it.
+        return None, None, None
+    return index, metadata, load_shadow_index("data/kb_index.faiss")
+
+if load_kb()[0] is not None:
     st.sidebar.success("Knowledge index loaded.")
-except Exception:
-    INDEX, METADATA = None, None
-    # Quiet: index might not exist yet; admin UI can build it.
+
+# ----- Gemini context cache (static prompt prefix) -----
+CONTEXT_CACHE_TTL = datetime.timedelta(hours=1)
+HOT_KB_CHUNKS = 20  # number of KB entries registered alongside the system prompt
+
+@st.cache_resource
+def _context_cache_state():
+    # "target" is (model, system_prompt, cached_ids), swapped as one tuple so a request never
+    # pairs the new model with the old ids; None means no cache, use the plain model
+    return {"cache": None, "expires": 0.0, "target": None, "lock": threading.Lock()}
+
+def _prompt_target():
+    """Snapshot of (model, system_prompt, ids of KB entries already in the model's cached context)."""
+    return _context_cache_state()["target"] or (get_model(), CULTURE_SYSTEM_PROMPT, set())
+
+def _kb_chunk_text(metadata, i):
+    return f"[{metadata['source'][i]} | ID:{metadata['id'][i]} | Risk:{metadata['risk_level'][i]}]\n{metadata['detailed_answer'][i]}"
+
+def _refresh_context_cache(force: bool = False):
+    """
+    Register CULTURE_SYSTEM_PROMPT (plus the first HOT_KB_CHUNKS KB entries) with Gemini
+    context caching and switch new requests over to it, so this prefix isn't re-sent every
+    turn. Falls back to the plain model when caching is unavailable (e.g. prefix below the
+    minimum cacheable size). The new cache is created before the old one is deleted.
+    """
+    _, metadata, _ = load_kb()
+    _swap_context_cache(_context_cache_state(), metadata, force)
+
+def _swap_context_cache(state, metadata, force: bool = False):
+    # no Streamlit calls in here: _ensure_context_cache runs it on a worker thread
+    with state["lock"]:
+        if not force and time.time() < state["expires"]:
+            return  # another session refreshed it while we waited for the lock
+
+        hot = range(min(HOT_KB_CHUNKS, len(metadata["id"]))) if metadata is not None else range(0)
+        contents = []
+        if hot:
+            contents = ["Knowledge base (cited as [source | ID | Risk]):\n\n" + "\n\n".join(_kb_chunk_text(metadata, i) for i in hot)]
+        try:
+            cache = caching.CachedContent.create(
+                model=MODEL_NAME,
+                system_instruction=CULTURE_SYSTEM_PROMPT,
+                contents=contents,
+                ttl=CONTEXT_CACHE_TTL,
+            )
+        except Exception:
+            cache = None
+
+        old_cache = state["cache"]
+        if cache is None:
+            state["target"] = None
+            state["expires"] = time.time() + CONTEXT_CACHE_TTL.total_seconds()  # don't retry every turn
+        else:
+            ids = set(metadata["id"][:len(hot)]) if hot else set()
+            state["target"] = (genai.GenerativeModel.from_cached_content(cached_content=cache), "", ids)
+            # refresh a minute before the server-side TTL runs out
+            state["expires"] = time.time() + CONTEXT_CACHE_TTL.total_seconds() - 60
+        state["cache"] = cache
+
+        if old_cache is not None:
+            try:
+                old_cache.delete()
+            except Exception:
+                pass
+
+@st.cache_resource
+def _executor():
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="umeeda-context-cache")
+
+def _ensure_context_cache():
+    """
+    Start a background refresh once the context cache is due. Creating the cache is a
+    network round trip, so it runs alongside this turn's retrieval and generation, which
+    keep using the current target (the old cache stays valid for another minute).
+    """
+    state = _context_cache_state()
+    if time.time() >= state["expires"] and not state["lock"].locked():
+        _, metadata, _ = load_kb()
+        _executor().submit(_swap_context_cache, state, metadata)
+
+# ----- Reply cache (exact LRU + semantic) -----
+REPLY_CACHE_SIZE = 1024
+REPLY_CACHE_TTL = 3600  # seconds
+SEMANTIC_CACHE_THRESHOLD = 0.97  # cosine similarity to a previously answered query
+
+@st.cache_resource
+def _reply_cache():
+    """Shared across sessions. Cleared (via _reply_cache.clear()) whenever the KB is rebuilt."""
+    # entries are (reply, stored_at); the lock guards both tiers against concurrent sessions
+    return {"exact": OrderedDict(), "sem_index": None, "sem_replies": [], "lock": threading.Lock()}
+
+def _cache_lookup(query: str, q_emb):
+    cache = _reply_cache()
+    index, _, _ = load_kb()
+    key = (query, index.ntotal if index is not None else 0)
+    now = time.time()
+    with cache["lock"]:
+        hit = cache["exact"].get(key)
+        if hit is not None:
+            if now - hit[1] < REPLY_CACHE_TTL:
+                cache["exact"].move_to_end(key)
+                return hit[0]
+            del cache["exact"][key]
+        sem_index = cache["sem_index"]
+        if sem_index is not None and sem_index.ntotal:
+            D, I = sem_index.search(q_emb, 1)
+            if I[0][0] >= 0 and D[0][0] >= SEMANTIC_CACHE_THRESHOLD:
+                reply, stored_at = cache["sem_replies"][I[0][0]]
+                if now - stored_at < REPLY_CACHE_TTL:
+                    return reply
+    return None
+
+def _cache_store(query: str, q_emb, reply: str):
+    cache = _reply_cache()
+    index, _, _ = load_kb()
+    key = (query, index.ntotal if index is not None else 0)
+    entry = (reply, time.time())
+    with cache["lock"]:
+        cache["exact"][key] = entry
+        if len(cache["exact"]) > REPLY_CACHE_SIZE:
+            cache["exact"].popitem(last=False)
+        # semantic tier is append-only; start it over when full (old entries age out via the TTL anyway)
+        if cache["sem_index"] is None or cache["sem_index"].ntotal >= REPLY_CACHE_SIZE:
+            cache["sem_index"] = faiss.IndexFlatIP(q_emb.shape[1])
+            cache["sem_replies"] = []
+        cache["sem_index"].add(q_emb)
+        cache["sem_replies"].append(entry)
 
 # ----- Decision logic: short answer vs RAG -----
 HIGH_CONFIDENCE_THRESHOLD = 0.78  # tune if needed
+NO_HOPE_THRESHOLD = 0.35  # below this the KB has nothing relevant; don't spend a model call
+NO_ANSWER = "Sorry — I couldn't produce an answer."
+SEARCH_LATENCY_LOG = 200  # (words, nprobe, efSearch, ms) samples kept per session
+# The batcher prepends CULTURE_SYSTEM_PROMPT (or it is already in the context cache)
+RAG_PROMPT_TMPL = "Retrieved knowledge:\n{ctx}\n\nUser question:\n{q}\n\nAnswer using the retrieved knowledge and cite sources."
+
+def decide_reply(query: str, on_chunk=None):
+    """Return an appropriate reply string, serving repeat questions from the reply cache.
+
+    If on_chunk is given, it is called with the partial text as the model streams.
+    """
+    # embed once: used for the semantic cache and for KB retrieval
+    q_emb = embed_queries([query])
+    cached = _cache_lookup(query, q_emb)
+    if cached is not None:
+        return cached
+
+    _ensure_context_cache()
+
+    reply = _compose_reply(query, q_emb, on_chunk)
+    # don't cache failures: errors and empty/blocked generations are usually transient
+    if not reply.startswith(("Error contacting model", NO_ANSWER)):
+        _cache_store(query, q_emb, reply)
+    return reply
 
-def decide_reply(query: str):
+def _compose_reply(query: str, q_emb, on_chunk=None):
     """Return an appropriate reply string using the KB if available."""
-    if INDEX is None or METADATA is None:
+    index, metadata, shadow = load_kb()
+    if index is None or metadata is None:
         # no KB: fallback to simple model call with culture prompt
-        prompt = CULTURE_SYSTEM_PROMPT + "\n\nUser: " + query
         try:
-            resp = model.generate_content(prompt)
-            text = getattr(resp, "text", None)
-            if not text and hasattr(resp, "candidates") and resp.candidates:
-                text = getattr(resp.candidates[0], "content", None)
-            return text.strip() if text else "Sorry — I couldn't produce an answer."
+            model, system_prompt, _ = _prompt_target()
+            text = _get_batcher().generate("User: " + query, on_chunk=on_chunk, target=(model, system_prompt))
+            return text.strip() or NO_ANSWER
         except Exception as e:
             return f"Error contacting model: {e}"
 
-    # Use KB retrieval
-    results = retrieve(query, INDEX, METADATA, top_k=4)
-    if not results:
+    # Use KB retrieval; ids index straight into the metadata columns
+    # nprobe/efSearch follow query length unless overridden in the admin sidebar
+    if st.session_state.get("search_override"):
+        nprobe, ef_search = st.session_state.get("nprobe"), st.session_state.get("ef_search")
+    else:
+        nprobe, ef_search = search_breadth(len(query.split()))
+    top_k = 4
+    # with a shadow index, oversample the PQ search and keep the best top_k after exact re-scoring
+    fetch_k = top_k * SHADOW_K_FACTOR if shadow is not None else top_k
+    t0 = time.perf_counter()
+    ids, scores = retrieve([query], index, metadata, top_k=fetch_k, q_emb=q_emb, nprobe=nprobe, ef_search=ef_search)[0]
+    # kept for offline tuning of search_breadth
+    latencies = st.session_state.setdefault("search_latency", [])
+    latencies.append((len(query.split()), nprobe, ef_search, (time.perf_counter() - t0) * 1000))
+    del latencies[:-SEARCH_LATENCY_LOG]
+    if len(ids) == 0:
         return "I couldn't find a direct reference. Please rephrase or ask for more details."
+    if shadow is not None:
+        # PQ scores are approximate: make the threshold decisions below on exact scores
+        scores = exact_scores(shadow, q_emb, ids)
+        order = np.argsort(-scores)[:top_k]
+        ids, scores = ids[order], scores[order]
 
-    top = results[0]
-    score = float(top.get("score", 0.0))
+    top = ids[0]
+    score = float(scores[0])
+    if score < NO_HOPE_THRESHOLD:
+        return "I couldn't find a reliable match — could you rephrase?"
 
-    # If metadata uses different keys (from CSV ingestion), handle gracefully:
-    short_answer = top.get("short_answer") or top.get("text") or ""
-    detailed_answer = top.get("detailed_answer") or top.get("text") or ""
-    entry_id = top.get("id") or top.get("chunk_id") or "unknown"
-    source = top.get("source", "unknown")
-    risk = top.get("risk_level", top.get("risk", "Info"))
+    short_answer = metadata["short_answer"][top]
+    entry_id = metadata["id"][top]
+    source = metadata["source"][top]
 
     # If high confidence, return short answer + citation
     if score >= HIGH_CONFIDENCE_THRESHOLD and short_answer:
         prefix = ""
         # if any retrieved item is urgent, include warning
-        if any((r.get("risk_level","").lower()=="urgent") or (r.get("risk","").lower()=="urgent") for r in results):
+        if np.any(metadata["risk_lc"][ids] == "urgent"):
             prefix = "⚠️ This appears urgent. Please consult a qualified person.\n\n"
         return f"{prefix}{short_answer}\n\nSource: [{source} | ID:{entry_id}]"
 
     # Otherwise build a RAG prompt using detailed answers
-    rag_context = ""
-    for r in results:
-        r_src = r.get("source", "unknown")
-        r_id = r.get("id", r.get("chunk_id", "unknown"))
-        r_risk = r.get("risk_level", r.get("risk", "Info"))
-        r_detail = r.get("detailed_answer") or r.get("text") or ""
-        rag_context += f"[{r_src} | ID:{r_id} | Risk:{r_risk}]\n{r_detail}\n\n"
-
-    prompt = CULTURE_SYSTEM_PROMPT + "\n\nRetrieved knowledge:\n" + rag_context + "\nUser question:\n" + query + "\n\nAnswer using the retrieved knowledge and cite sources."
+    # (entries already in the Gemini context cache are not re-sent)
+    model, system_prompt, cached_ids = _prompt_target()
+    src, mid = metadata["source"][ids], metadata["id"][ids]
+    risk, detail = metadata["risk_level"][ids], metadata["detailed_answer"][ids]
+    rag_context = "\n\n".join(
+        f"[{r_src} | ID:{r_id} | Risk:{r_risk}]\n{'(see knowledge base above)' if r_id in cached_ids else r_detail}"
+        for r_src, r_id, r_risk, r_detail in zip(src, mid, risk, detail)
+    )
+    body = RAG_PROMPT_TMPL.format(ctx=rag_context, q=query)
     try:
-        resp = model.generate_content(prompt)
-        text = getattr(resp, "text", None)
-        if not text and hasattr(resp, "candidates") and resp.candidates:
-            text = getattr(resp.candidates[0], "content", None)
-        final = text.strip() if text else "Sorry — I couldn't produce an answer."
+        text = _get_batcher().generate(body, on_chunk=on_chunk, target=(model, system_prompt))
+        final = text.strip() or NO_ANSWER
         # Append simple sources list
-        sources = ", ".join(sorted({f"{r.get('source','unknown')} (ID {r.get('id', r.get('chunk_id','?'))})" for r in results}))
+        sources = ", ".join(np.unique(np.char.add(np.char.add(src.astype(str), " (ID "), np.char.add(mid.astype(str), ")"))))
         return final + "\n\nSources: " + sources
     except Exception as e:
         return f"Error contacting model: {e}"
 
 
 
+# ----- Chat history: last HISTORY_TURNS turns in memory, everything in SQLite -----
+HISTORY_TURNS = 20
+HISTORY_DB_PATH = "data/history.db"
+
+@st.cache_resource
+def _history_db():
+    os.makedirs(os.path.dirname(HISTORY_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(HISTORY_DB_PATH, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS turns ("
+                 "id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL, user_id TEXT, query TEXT, reply TEXT)")
+    conn.execute("CREATE INDEX IF NOT EXISTS turns_user ON turns (user_id, id)")
+    conn.commit()
+    # one connection shared by all sessions; serialize access to it
+    return conn, threading.Lock()
+
+def _save_turn(query: str, reply: str):
+    conn, lock = _history_db()
+    with lock:
+        conn.execute("INSERT INTO turns (ts, user_id, query, reply) VALUES (?, ?, ?, ?)",
+                     (time.time(), st.session_state.user_id, query, reply))
+        conn.commit()
+
+def _older_turns(skip: int, limit: int):
+    """Turns for this session older than the newest `skip` ones, oldest first."""
+    conn, lock = _history_db()
+    with lock:
+        rows = conn.execute("SELECT query, reply FROM turns WHERE user_id = ? ORDER BY id DESC LIMIT ? OFFSET ?",
+                            (st.session_state.user_id, limit, skip)).fetchall()
+    return rows[::-1]
+
 if "history" not in st.session_state:
     st.session_state.history = []
+st.session_state.setdefault("user_id", uuid.uuid4().hex)
+st.session_state.setdefault("older_pages", 0)
 
 # Sidebar admin: upload PDFs or import CSV and rebuild
 st.sidebar.header("Umeeda — Admin")
 
+UPLOAD_CHUNK = 1 << 20  # 1 MiB
+
+@st.cache_data
+def _file_digest(path: str, mtime: float, size: int) -> str:
+    # mtime/size are only part of the cache key, so an edited file is re-hashed
+    h = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(UPLOAD_CHUNK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _save_upload(uploaded, save_path: str, dedupe_dir: str = None) -> bool:
+    """
+    Hash an upload in UPLOAD_CHUNK blocks and, only if no identical file already exists
+    at save_path or anywhere in dedupe_dir, copy it to save_path (via a .part file).
+    Returns False, writing nothing, for a duplicate.
+    """
+    h = hashlib.blake2b()
+    uploaded.seek(0)
+    for block in iter(lambda: uploaded.read(UPLOAD_CHUNK), b""):
+        h.update(block)
+    digest = h.hexdigest()
+
+    candidates = [save_path]
+    if dedupe_dir and os.path.isdir(dedupe_dir):
+        candidates += [os.path.join(dedupe_dir, fn) for fn in os.listdir(dedupe_dir)]
+    for path in candidates:
+        if not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        if _file_digest(path, stat.st_mtime, stat.st_size) == digest:
+            return False
+
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    tmp_path = save_path + ".part"
+    uploaded.seek(0)
+    with open(tmp_path, "wb") as f:
+        shutil.copyfileobj(uploaded, f, UPLOAD_CHUNK)
+    os.replace(tmp_path, save_path)
+    return True
+
+def _handle_upload(uploaded, save_path: str, saved_msg: str, duplicate_msg: str, dedupe_dir: str = None):
+    """
+    Save an upload once. The upload stays attached across reruns, so the outcome is
+    remembered per file_id and just re-shown afterwards.
+    """
+    handled = st.session_state.setdefault("_handled_uploads", {})
+    if uploaded.file_id not in handled:
+        saved = _save_upload(uploaded, save_path, dedupe_dir=dedupe_dir)
+        handled[uploaded.file_id] = (saved, saved_msg if saved else duplicate_msg)
+    saved, msg = handled[uploaded.file_id]
+    (st.sidebar.success if saved else st.sidebar.info)(msg)
+
 # Upload PDF(s)
 uploaded_pdf = st.sidebar.file_uploader("Upload PDF to KB (then click Rebuild)", type=["pdf"])
 if uploaded_pdf:
-    os.makedirs("data/sources", exist_ok=True)
-    save_path = os.path.join("data/sources", uploaded_pdf.name)
-    with open(save_path, "wb") as f:
-        f.write(uploaded_pdf.getbuffer())
-    st.sidebar.success(f"Saved {uploaded_pdf.name} to data/sources. Click Rebuild KB index to index it.")
+    _handle_upload(uploaded_pdf, os.path.join("data/sources", uploaded_pdf.name),
+                   f"Saved {uploaded_pdf.name} to data/sources. Click Rebuild KB index to index it.",
+                   f"{uploaded_pdf.name} is already in data/sources; nothing to save.",
+                   dedupe_dir="data/sources")
 
 # Upload CSV (structured KB)
 uploaded_csv = st.sidebar.file_uploader("Upload CSV KB (id,theme,sample_questions,short_answer,detailed_answer,risk_level,source)", type=["csv"])
 if uploaded_csv:
-    os.makedirs("data", exist_ok=True)
-    csv_path = os.path.join("data", "kb_import.csv")
-    with open(csv_path, "wb") as f:
-        f.write(uploaded_csv.getbuffer())
-    st.sidebar.success(f"Saved CSV as data/kb_import.csv. Click Import CSV to ingest.")
+    _handle_upload(uploaded_csv, os.path.join("data", "kb_import.csv"),
+                   "Saved CSV as data/kb_import.csv. Click Import CSV to ingest.",
+                   "data/kb_import.csv already has this content; nothing to save.")
 
 # Buttons to import CSV or rebuild index
 if st.sidebar.button("Import CSV (build index from CSV)"):
@@ -139,7 +421,9 @@ if st.sidebar.button("Import CSV (build index from CSV)"):
         try:
             st.sidebar.info("Ingesting CSV and building index (this can take a moment)...")
             ingest_csv(csv_path, index_path="data/kb_index.faiss", meta_path="data/metadata.pkl")
-            INDEX, METADATA = load_index("data/kb_index.faiss", "data/metadata.pkl")
+            load_kb.clear()
+            _reply_cache.clear()
+            _refresh_context_cache(force=True)
             st.sidebar.success("CSV ingested and index built.")
         except Exception as e:
             st.sidebar.error(f"Ingest failed: {e}")
@@ -148,11 +432,22 @@ if st.sidebar.button("Rebuild KB index from PDFs (data/sources)"):
     try:
         st.sidebar.info("Building index from PDFs in data/sources...")
         build_index("data/sources", index_path="data/kb_index.faiss", meta_path="data/metadata.pkl")
-        INDEX, METADATA = load_index("data/kb_index.faiss", "data/metadata.pkl")
+        load_kb.clear()
+        _reply_cache.clear()
+        _refresh_context_cache(force=True)
         st.sidebar.success("Index rebuilt from PDFs.")
     except Exception as e:
         st.sidebar.error(f"Rebuild failed: {e}")
 
+# Retrieval tuning: by default nprobe/efSearch follow query length (kb_loader.search_breadth)
+with st.sidebar.expander("Retrieval tuning"):
+    st.checkbox("Override adaptive search breadth", key="search_override")
+    st.slider("nprobe (IVF indexes)", 1, 64, 8, key="nprobe")
+    st.slider("efSearch (HNSW indexes)", 16, 256, 64, key="ef_search")
+    latencies = st.session_state.get("search_latency", [])
+    if latencies:
+        st.caption(f"Last {len(latencies)} searches: median {np.median([r[-1] for r in latencies]):.2f} ms")
+
 # ----- Chat input using on_change callback (clears input safely) -----
 def _on_submit():
     query = st.session_state.get("user_input", "").strip()
@@ -160,11 +455,19 @@ def _on_submit():
         # nothing entered — do nothing (or show warning via session_state flag)
         st.session_state.setdefault("_show_warning", True)
         return
-    # compute reply and append to history
     st.session_state.setdefault("history", [])
-    # perform the model call (synchronous)
-    reply = decide_reply(query)
-    st.session_state.history.append((query, reply))
+    history = st.session_state.history
+    if st.session_state.get("_pending_reply"):
+        # the previous reply was still streaming when this was submitted, which stopped
+        # that run; keep what arrived and record the turn as interrupted
+        prev_query, partial = history[-1]
+        partial = (partial + "\n\n" if partial else "") + "(reply interrupted)"
+        history[-1] = (prev_query, partial)
+        _save_turn(prev_query, partial)
+    # append an empty reply now; it is streamed into history[-1] below the history loop
+    history.append((query, ""))
+    history[:] = history[-HISTORY_TURNS:]
+    st.session_state["_pending_reply"] = True
     # clear the input by setting the session_state BEFORE rerender completes
     st.session_state["user_input"] = ""
     # clear any warning flag
@@ -183,31 +486,55 @@ user_input = st.text_input("Ask Umeeda something...", key="user_input", on_chang
 #     st.warning("Please enter a prompt before sending.")
 
 
-# Display history
-for u, b in st.session_state.history:
-#    st.markdown(f"<div style='background:#f0f2f6;border-radius:12px;padding:8px;margin:6px 0;max-width:90%'><b>You:</b> {u}</div>", unsafe_allow_html=True)
-#    st.markdown(f"<div style='background:#fff8e1;border-radius:12px;padding:8px;margin:6px 0;max-width:90%'><b>Umeeda:</b> {b}</div>", unsafe_allow_html=True)
-
 # User message (dark text on light gray)
-    st.markdown(f"""
-    <div style='background:#f0f2f6;
-                border-radius:12px;
-                padding:8px;
-                margin:6px 0;
-                max-width:90%;
-                color:#1C2833;'>  <!-- dark text -->
-        <b style='color:#154360;'>You:</b> {u}
-    </div>
-    """, unsafe_allow_html=True)
-
+_USER_DIV = ("<div style='background:#f0f2f6;border-radius:12px;padding:8px;margin:6px 0;max-width:90%;"
+             "color:#1C2833;'><b style='color:#154360;'>You:</b> {}</div>")
 # Umeeda message (dark purple text on cream background)
-    st.markdown(f"""
-    <div style='background:#fff8e1;
-                border-radius:12px;
-                padding:8px;
-                margin:6px 0;
-                max-width:90%;
-                color:#4A235A;'>  <!-- darker text -->
-        <b style='color:#6C3483;'>Umeeda:</b> {b}
-    </div>
-    """, unsafe_allow_html=True)
+_BOT_DIV = ("<div style='background:#fff8e1;border-radius:12px;padding:8px;margin:6px 0;max-width:90%;"
+            "color:#4A235A;'><b style='color:#6C3483;'>Umeeda:</b> {}</div>")
+
+def _to_html(text):
+    # newlines become <br>: a blank line would end the raw-HTML block in Markdown
+    return html.escape(text).replace("\n", "<br>")
+
+def _turns_html(turns):
+    """One HTML string for all turns, so they go to the browser as a single element."""
+    return "".join(_USER_DIV.format(_to_html(u)) + _BOT_DIV.format(_to_html(b)) for u, b in turns)
+
+
+# Display history (the in-flight turn, if any, is rendered separately below).
+# _pending_reply stays set until the reply is saved, so a run that is stopped mid-stream
+# (e.g. by a sidebar click) regenerates the reply on the next run.
+pending = st.session_state.get("_pending_reply", False)
+finished = st.session_state.history[:-1] if pending else st.session_state.history
+
+# older turns only live in SQLite; page them in on request
+if st.button("Show older turns"):
+    st.session_state.older_pages += 1
+older = []
+if st.session_state.older_pages:
+    older = _older_turns(len(finished), HISTORY_TURNS * st.session_state.older_pages)
+if older or finished:
+    st.markdown(_turns_html(older + list(finished)), unsafe_allow_html=True)
+
+# Stream the pending reply into a placeholder so only this message re-renders per chunk
+if pending:
+    query = st.session_state.history[-1][0]
+    placeholder = st.empty()
+
+    def _on_chunk(text):
+        st.session_state.history[-1] = (query, text)
+        placeholder.markdown(_turns_html([(query, text)]), unsafe_allow_html=True)
+
+    _on_chunk("")
+    # catch Exception only: Streamlit's rerun/stop signals must still interrupt the turn
+    try:
+        reply = decide_reply(query, on_chunk=_on_chunk)
+    except Exception as e:
+        reply = f"Sorry — something went wrong: {e}"
+    _on_chunk(reply)
+    try:
+        _save_turn(query, reply)
+    except Exception as e:
+        st.warning(f"Couldn't save this turn to history: {e}")
+    st.session_state["_pending_reply"] = False
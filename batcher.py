@@ -0,0 +1,178 @@
+# batcher.py
+import re
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Sentinel pushed onto a request's queue once its reply is complete
+_DONE = object()
+
+_ANSWER_SPLIT = re.compile(r"^\s*A\[(\d+)\]:", re.MULTILINE)
+# Bodies containing Q[i]/A[i] markers of their own could steer the split, so never batch them
+_MARKER = re.compile(r"[AQ]\[\d+\]")
+
+
+class PromptBatcher:
+    """
+    Collects prompts from concurrent sessions and sends them to the model together.
+
+    A collector thread takes prompts off the queue. When no model call is in flight it
+    sends what it has straight away; otherwise it waits up to max_delay seconds (or until
+    max_batch prompts are queued) to fill a batch. A lone prompt is sent as a normal
+    streaming call; several prompts are packed into one call using Q[i] / A[i] framing
+    and the answer is split back out per caller. The system prompt is sent once per call,
+    not once per question. The calls themselves run on a worker pool, so a long
+    streaming reply never holds up other sessions.
+
+    Each prompt names its own (model, system_prompt) target; only prompts with the same
+    target are batched together.
+
+    Batching puts prompts from different sessions into one model call, so a reply can
+    leak one user's question or context into another's answer if the model mislabels
+    it. Answers are only accepted when their markers appear exactly once and in order;
+    anything else is retried as a single call. Prompts that contain markers themselves
+    are always sent alone.
+    """
+
+    def __init__(self, max_batch: int = 4, max_delay: float = 0.05, max_workers: int = 16):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prompt-call")
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="prompt-batcher", daemon=True)
+        self._thread.start()
+
+    def generate(self, body: str, on_chunk=None, target=None) -> str:
+        """
+        Queue body (the prompt without the system prompt) for target, a (model, system_prompt)
+        pair, and block until it is answered. system_prompt may be empty when the model
+        already carries it in cached content. on_chunk is called with the partial text from
+        the calling thread, so it is safe to update Streamlit elements from it.
+        """
+        out = queue.Queue()
+        self._queue.put((target, body, out))
+        text = ""
+        while True:
+            item = out.get()
+            if item is _DONE:
+                return text
+            if isinstance(item, Exception):
+                raise item
+            text += item
+            if on_chunk:
+                on_chunk(text)
+
+    # --------- collector thread: only gathers and dispatches ---------
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            with self._lock:
+                busy = self._in_flight > 0
+            # an idle batcher has nothing to batch with, so don't make a lone prompt wait
+            deadline = time.monotonic() + (self.max_delay if busy else 0)
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining <= 0:
+                        batch.append(self._queue.get_nowait())
+                    else:
+                        batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            groups = {}
+            for target, body, out in batch:
+                if _MARKER.search(body):
+                    model, system_prompt = target
+                    self._dispatch(self._send_single, [out], model, system_prompt, body, out)
+                    continue
+                groups.setdefault(target, []).append((body, out))
+            for (model, system_prompt), group in groups.items():
+                if len(group) == 1:
+                    body, out = group[0]
+                    self._dispatch(self._send_single, [out], model, system_prompt, body, out)
+                else:
+                    self._dispatch(self._send_batch, [out for _, out in group], model, system_prompt, group)
+
+    def _dispatch(self, fn, outs, *args):
+        """Run fn(*args) on the pool; if it raises, the error goes to every caller in outs."""
+        with self._lock:
+            self._in_flight += 1
+
+        def call():
+            try:
+                fn(*args)
+            except Exception as e:
+                for out in outs:
+                    out.put(e)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+
+        self._pool.submit(call)
+
+    # --------- worker threads ---------
+    def _send_single(self, model, system_prompt: str, body: str, out: queue.Queue):
+        # system_prompt is empty when it already lives in the model's cached content
+        prompt = system_prompt + "\n\n" + body if system_prompt else body
+        resp = model.generate_content(prompt, stream=True)
+        for chunk in resp:
+            out.put(_extract_text(chunk))
+        out.put(_DONE)
+
+    def _send_batch(self, model, system_prompt: str, batch):
+        parts = [system_prompt + "\n\n" if system_prompt else "",
+                 f"You will be given {len(batch)} separate requests labelled Q[1]..Q[{len(batch)}]. "
+                 "Answer each one independently. Start each answer on a new line with A[i]: "
+                 "using the same number as its question, and do not add anything else.\n"]
+        for i, (body, _) in enumerate(batch, start=1):
+            parts.append(f"\nQ[{i}]:\n{body}\n")
+        resp = model.generate_content("".join(parts))
+        answers = _split_answers(_extract_text(resp), len(batch))
+
+        for i, (body, out) in enumerate(batch, start=1):
+            answer = answers.get(i)
+            if not answer:
+                # model dropped or mangled this answer: retry it as its own call, in parallel
+                self._dispatch(self._send_single, [out], model, system_prompt, body, out)
+                continue
+            out.put(answer)
+            out.put(_DONE)
+
+
+def _extract_text(resp, _getattr=getattr) -> str:
+    """
+    Text of a response or stream chunk, '' if it has none. resp.text raises when the
+    candidate was blocked or has no text parts, so fall back to the parts themselves.
+    """
+    try:
+        text = resp.text
+    except (ValueError, AttributeError):
+        text = None
+    if text:
+        return text
+    candidates = _getattr(resp, "candidates", None)
+    if not candidates:
+        return ""
+    parts = _getattr(_getattr(candidates[0], "content", None), "parts", None) or []
+    return "".join(_getattr(p, "text", "") or "" for p in parts)
+
+
+def _split_answers(text: str, count: int):
+    """
+    Split a batched reply on its A[i]: markers. Returns {i: answer} for the answers that
+    can be trusted. Markers must run 1..count in order; an answer followed by a
+    duplicate or out-of-order marker is dropped (and so retried on its own), as is
+    everything after it. Markers above count are treated as ordinary text.
+    """
+    answers = {}
+    marks = [m for m in _ANSWER_SPLIT.finditer(text) if 1 <= int(m.group(1)) <= count]
+    for n, m in enumerate(marks):
+        if int(m.group(1)) != n + 1:
+            answers.pop(n, None)
+            break
+        end = marks[n + 1].start() if n + 1 < len(marks) else len(text)
+        answers[n + 1] = text[m.end():end].strip()
+    return answers
@@ -13,6 +13,17 @@ import fitz  # PyMuPDF
 EMBED_MODEL_NAME = "all-MiniLM-L6-v2"  # change if you prefer another
 CHUNK_SIZE = 800
 CHUNK_OVERLAP = 150
+HNSW_M = 32        # graph degree for the HNSW index
+EF_SEARCH = 64     # HNSW search breadth; higher = better recall, slower
+# Product quantization (only used once the KB is big enough to train it)
+PQ_MIN_VECTORS = 1024
+PQ_M = 8           # sub-quantizers; must divide the embedding dim
+PQ_NBITS = 8
+NPROBE = 8         # IVF lists visited per query
+# PQ indexes get an exact IndexFlatIP "shadow" next to them (index_path + SHADOW_SUFFIX),
+# mmapped and only read to re-score the candidates the PQ search returns
+SHADOW_K_FACTOR = 4  # PQ candidates fetched per result kept after exact re-scoring
+SHADOW_SUFFIX = ".flat"
 
 MODEL = SentenceTransformer(EMBED_MODEL_NAME)
 
@@ -25,13 +36,114 @@ def _to_numpy32(x):
     arr = np.asarray(x, dtype="float32")
     return arr
 
-def _build_faiss_index(embeddings: np.ndarray) -> faiss.IndexFlatIP:
-    # embeddings expected to be float32 and already normalized
-    dim = embeddings.shape[1]
-    index = faiss.IndexFlatIP(dim)
+def _normalize_entry(e: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Fill the canonical metadata keys once at ingest time, resolving the CSV / PDF /
+    old-pickle key variants, so nothing downstream needs .get() fallback chains.
+    """
+    text = e.get("text") or ""
+    risk_level = str(e.get("risk_level") or e.get("risk") or "Info")
+    return {
+        **e,
+        "id": e.get("id") or e.get("chunk_id") or "unknown",
+        "chunk_id": e.get("chunk_id"),
+        "theme": e.get("theme") or "",
+        "source": e.get("source") or "unknown",
+        "risk_level": risk_level,
+        # lowercased copy so the urgent check is a plain array comparison
+        "risk_lc": risk_level.lower(),
+        "short_answer": e.get("short_answer") or text,
+        "detailed_answer": e.get("detailed_answer") or text,
+        "text": text,
+        "page": e.get("page"),
+    }
+
+META_COLUMNS = ("id", "chunk_id", "theme", "source", "risk_level", "risk_lc",
+                "short_answer", "detailed_answer", "text", "page")
+
+def _to_columns(entries: List[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+    """
+    Convert normalized metadata dicts into a struct-of-arrays keyed by column name,
+    where row i of every column belongs to FAISS vector i.
+    """
+    columns = {}
+    for key in META_COLUMNS:
+        arr = np.empty(len(entries), dtype=object)
+        arr[:] = [e[key] for e in entries]
+        columns[key] = arr
+    return columns
+
+def _build_faiss_index(embeddings: np.ndarray) -> faiss.Index:
+    # embeddings expected to be float32 and already normalized (inner product == cosine)
+    n, dim = embeddings.shape
+    if n < PQ_MIN_VECTORS or dim % PQ_M:
+        # small KB: PQ can't be trained meaningfully, keep full vectors in HNSW
+        index = faiss.index_factory(dim, f"HNSW{HNSW_M}", faiss.METRIC_INNER_PRODUCT)
+        index.add(embeddings)
+        return index
+
+    quantizer = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index = faiss.IndexIVFPQ(quantizer, dim, min(64, n // 40), PQ_M, PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+    index.train(embeddings)
+    index.nprobe = NPROBE
     index.add(embeddings)
     return index
 
+def _save_indexes(embeddings: np.ndarray, index_path: str) -> faiss.Index:
+    """Build + write the search index and, for PQ indexes, the exact shadow index."""
+    index = _build_faiss_index(embeddings)
+    _write_index(index, index_path)
+    shadow_path = index_path + SHADOW_SUFFIX
+    if isinstance(faiss.downcast_index(index), faiss.IndexIVFPQ):
+        shadow = faiss.IndexFlatIP(embeddings.shape[1])
+        shadow.add(embeddings)
+        _write_index(shadow, shadow_path)
+    elif os.path.exists(shadow_path):
+        # left over from an earlier PQ build; its row ids no longer match
+        os.remove(shadow_path)
+    return index
+
+def _write_index(index, index_path: str):
+    # write to a temp file and rename: a live process may have the old file mmapped
+    # (see _read_index), and truncating it in place would break that mapping
+    tmp_path = index_path + ".tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, index_path)
+
+def _set_search_params(index, ef_search: int = EF_SEARCH, nprobe: int = NPROBE):
+    index = faiss.downcast_index(index)
+    if hasattr(index, "nprobe"):
+        index.nprobe = nprobe
+    hnsw = getattr(index, "hnsw", None)
+    if hnsw is not None:
+        hnsw.efSearch = ef_search
+
+def search_breadth(tok_len: int) -> Tuple[int, int]:
+    """
+    (nprobe, efSearch) for a query of tok_len words. Short keyword queries are
+    recall-limited, so they search wider; long queries are already specific.
+    """
+    nprobe = 16 if tok_len < 6 else 8 if tok_len < 20 else 4
+    ef_search = 128 if tok_len < 6 else 64
+    return nprobe, ef_search
+
+def _search_params(index, nprobe: int, ef_search: int, keep: list):
+    """
+    Per-call faiss SearchParameters for index (None if it has no tunables). Unlike
+    _set_search_params this doesn't mutate the index, which is shared between sessions.
+    Nested parameter objects are appended to keep so they outlive the search call.
+    """
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIVF):
+        quantizer = _search_params(index.quantizer, nprobe, ef_search, keep)
+        params = faiss.SearchParametersIVF(nprobe=nprobe, quantizer_params=quantizer)
+    elif isinstance(index, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(efSearch=ef_search)
+    else:
+        return None
+    keep.append(params)
+    return params
+
 # --------- CSV ingestion (structured KB) ---------
 def ingest_csv(path: str,
                index_path: str = "venv\kb_index.faiss",
@@ -49,18 +161,20 @@ def ingest_csv(path: str,
     with open(path, newline="", encoding="utf-8") as f:
         reader = csv.DictReader(f)
         for row in reader:
+            # accept headers in any case (e.g. ID, Risk_Level)
+            row = {(k or "").strip().lower(): v for k, v in row.items()}
             sample_questions = [q.strip() for q in (row.get("sample_questions") or "").split(";") if q.strip()]
             short_answer = (row.get("short_answer") or "").strip()
             detailed_answer = (row.get("detailed_answer") or "").strip()
             theme = (row.get("theme") or "").strip()
             source = (row.get("source") or "").strip()
             id_ = (row.get("id") or f"row-{len(entries)+1}").strip()
-            risk = (row.get("risk_level") or "Info").strip()
+            risk = (row.get("risk_level") or row.get("risk") or "Info").strip()
 
             # single text field used for embedding/search
             embed_text = theme + " || " + " ; ".join(sample_questions) + " || " + short_answer
 
-            entries.append({
+            entries.append(_normalize_entry({
                 "id": id_,
                 "theme": theme,
                 "sample_questions": sample_questions,
@@ -72,7 +186,7 @@ def ingest_csv(path: str,
                 "text": embed_text,
                 "page": None,
                 "chunk_id": id_,
-            })
+            }))
 
     if len(entries) == 0:
         raise RuntimeError("No rows found in CSV or CSV empty.")
@@ -83,11 +197,10 @@ def ingest_csv(path: str,
     embeddings = _to_numpy32(embeddings)
     faiss.normalize_L2(embeddings)
 
-    index = _build_faiss_index(embeddings)
-    faiss.write_index(index, index_path)
+    index = _save_indexes(embeddings, index_path)
 
     with open(meta_path, "wb") as f:
-        pickle.dump(entries, f)
+        pickle.dump(_to_columns(entries), f)
 
     print("CSV ingest complete. Index vectors:", index.ntotal)
     return index_path, meta_path
@@ -145,7 +258,7 @@ def build_index(source_folder: str = "data/sources",
             chunks = chunk_text(page_text)
             for i, c in enumerate(chunks):
                 chunk_id = f"{fn}::p{page_num}::c{i}"
-                docs.append({
+                docs.append(_normalize_entry({
                     "id": chunk_id,
                     "source": fn,
                     "page": page_num,
@@ -156,7 +269,7 @@ def build_index(source_folder: str = "data/sources",
                     "short_answer": "",
                     "detailed_answer": c,
                     "risk_level": "Info",
-                })
+                }))
 
     if len(docs) == 0:
         raise RuntimeError("No PDF documents found in source_folder or no text extracted.")
@@ -167,54 +280,87 @@ def build_index(source_folder: str = "data/sources",
     embeddings = _to_numpy32(embeddings)
     faiss.normalize_L2(embeddings)
 
-    index = _build_faiss_index(embeddings)
-    faiss.write_index(index, index_path)
+    index = _save_indexes(embeddings, index_path)
 
     with open(meta_path, "wb") as f:
-        pickle.dump(docs, f)
+        pickle.dump(_to_columns(docs), f)
 
     print("PDF index built:", index.ntotal, "vectors.")
     return index_path, meta_path
 
 # --------- Load / Retrieve ----------
-def load_index(index_path: str = "data/kb_index.faiss", meta_path: str = "data/metadata.pkl"):
+def _read_index(path: str):
+    """
+    Read an index memory-mapped and read-only, so the OS page cache holds the vectors
+    instead of a private copy. IO_FLAG_MMAP_IFC (newer faiss) maps flat and HNSW storage
+    as well; older builds only have IO_FLAG_MMAP, which maps IVF inverted lists alone.
+    """
+    flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    try:
+        return faiss.read_index(path, flag | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        # not every index type / faiss build supports mmap; fall back to a normal load
+        return faiss.read_index(path)
+
+def load_index(index_path: str = "data/kb_index.faiss", meta_path: str = "data/metadata.pkl",
+               ef_search: int = EF_SEARCH, nprobe: int = NPROBE):
     if not os.path.exists(index_path) or not os.path.exists(meta_path):
         raise FileNotFoundError("Index or metadata not found. Run build_index() or ingest_csv() first.")
-    index = faiss.read_index(index_path)
+    index = _read_index(index_path)
+    _set_search_params(index, ef_search, nprobe)
     with open(meta_path, "rb") as f:
         metadata = pickle.load(f)
+    if isinstance(metadata, list):
+        # pickles written before the columnar layout
+        metadata = _to_columns([_normalize_entry(e) for e in metadata])
+    elif "risk_lc" not in metadata:
+        metadata["risk_lc"] = np.char.lower(metadata["risk_level"].astype(str)).astype(object)
     return index, metadata
 
-def retrieve(query: str, index: faiss.IndexFlatIP = None, metadata: List[Dict[str, Any]] = None, top_k: int = 4):
+def load_shadow_index(index_path: str = "data/kb_index.faiss"):
+    """The exact shadow index written next to a PQ index, memory-mapped; None if there is none."""
+    shadow_path = index_path + SHADOW_SUFFIX
+    if not os.path.exists(shadow_path):
+        return None
+    return _read_index(shadow_path)
+
+def exact_scores(shadow, q_emb: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """Exact inner-product scores of rows ids against a single query embedding (1, dim)."""
+    if len(ids) == 0:
+        return np.empty(0, dtype="float32")
+    return shadow.reconstruct_batch(np.asarray(ids, dtype="int64")) @ q_emb[0]
+
+def embed_queries(queries: List[str]) -> np.ndarray:
+    """Embed queries in one pass; returns a normalized, C-contiguous float32 array of shape (n, dim)."""
+    q_emb = MODEL.encode(queries, convert_to_numpy=True, batch_size=max(1, len(queries)))
+    q_emb = np.ascontiguousarray(_to_numpy32(q_emb))
+    faiss.normalize_L2(q_emb)
+    return q_emb
+
+def retrieve(queries: List[str], index: faiss.Index = None, metadata: Dict[str, np.ndarray] = None, top_k: int = 4,
+             q_emb: np.ndarray = None, nprobe: int = None,
+             ef_search: int = None) -> List[Tuple[np.ndarray, np.ndarray]]:
     """
-    Returns a list of results where each result contains:
-    {
-      score, id, short_answer, detailed_answer, risk_level, source, text, page, chunk_id
-    }
+    Search all queries with a single index.search call.
+    Returns one (ids, scores) pair per query, best match first. ids are FAISS row ids
+    and index straight into the metadata columns, e.g. metadata["source"][ids].
+    Pass q_emb (from embed_queries) to reuse embeddings computed by the caller.
+    nprobe / ef_search default to search_breadth() of the shortest query in the batch.
     """
-    if index is None or metadata is None:
+    empty = (np.empty(0, dtype="int64"), np.empty(0, dtype="float32"))
+    if not queries:
         return []
+    if index is None or metadata is None:
+        return [empty for _ in queries]
 
-    q_emb = MODEL.encode([query], convert_to_numpy=True)
-    q_emb = _to_numpy32(q_emb)
-    faiss.normalize_L2(q_emb)
-    D, I = index.search(q_emb, top_k)
+    if q_emb is None:
+        q_emb = embed_queries(queries)
+    auto_nprobe, auto_ef = search_breadth(min(len(q.split()) for q in queries))
+    keep = []
+    params = _search_params(index, nprobe or auto_nprobe, ef_search or auto_ef, keep)
+    D, I = index.search(q_emb, top_k, params=params)
     results = []
-    for score, idx in zip(D[0], I[0]):
-        if idx < 0:
-            continue
-        m = metadata[idx]
-        # normalize keys across CSV vs PDF entries
-        res = {
-            "score": float(score),
-            "id": m.get("id") or m.get("chunk_id"),
-            "short_answer": m.get("short_answer", ""),
-            "detailed_answer": m.get("detailed_answer", m.get("text", "")),
-            "risk_level": m.get("risk_level", m.get("risk", "Info")),
-            "source": m.get("source", "unknown"),
-            "text": m.get("text", ""),
-            "page": m.get("page"),
-            "chunk_id": m.get("chunk_id"),
-        }
-        results.append(res)
+    for row_scores, row_ids in zip(D, I):
+        valid = row_ids >= 0
+        results.append((row_ids[valid], row_scores[valid]))
     return results